@@ -1,7 +1,25 @@
 import streamlit as st
-from transformers import pipeline
+from transformers import (
+    AutoImageProcessor,
+    AutoModelForCausalLM,
+    AutoModelForImageClassification,
+    AutoTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+from optimum.onnxruntime import ORTModelForCausalLM, ORTModelForImageClassification, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
 from PIL import Image
-import io
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Event, Thread
+import queue
+import onnxruntime
+import os
+import shutil
+import tempfile
+import torch
 
 # Set page configuration
 st.set_page_config(
@@ -10,6 +28,250 @@ st.set_page_config(
     layout="wide"
 )
 
+EMOTION_MODEL = "LaiMein/Facial-Emotion-Recognition"
+# Smallest first: decode cost scales with parameter count, so the heavier models are opt-in
+STORY_MODELS = ["distilbert/distilgpt2", "openai-community/gpt2", "openai-community/gpt2-xl"]
+STORY_PROMPT = "Tell a short creative story about this {emotion} person"
+
+FOOTER_HTML = (
+    "<div style='text-align: center; color: #666;'>"
+    "Powered by 🤗 Transformers | Built with Streamlit"
+    "</div>"
+)
+
+# Largest size the uploaded image is decoded at; the column never displays it any bigger
+MAX_DECODE_SIZE = (1024, 1024)
+# The classifier resizes to 224×224 internally, so hand it a small image to begin with
+CLASSIFIER_INPUT_SIZE = (256, 256)
+
+# Run inference on the GPU when one is available
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# On the CPU, run exported ONNX models so ONNX Runtime can fuse attention/MatMul/GELU kernels
+USE_ONNX = DEVICE.type == "cpu"
+ONNX_CACHE_DIR = Path(__file__).parent / ".onnx_cache"
+# Half precision halves VRAM and doubles matmul throughput on the GPU
+TORCH_DTYPE = torch.float16 if DEVICE.type == "cuda" else torch.float32
+
+# Batch sizes used when several images are uploaded at once
+EMOTION_BATCH_SIZE = 8
+STORY_BATCH_SIZE = 4
+
+# Load models when the page first renders instead of on the first click; set WARMUP=0 to skip in development
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+
+# Seconds to wait for the next streamed token before giving up on a generation
+STREAM_TIMEOUT = 120
+
+
+# Intra-op threads stay at torch's default of one per physical core; only the interop pool is pinned.
+# Streamlit re-executes this script on every rerun, but the interop thread count can only be set once per process.
+try:
+    torch.set_num_interop_threads(1)
+except RuntimeError:
+    pass
+
+
+def onnx_session_options():
+    # Keep ONNX Runtime's default intra-op threads (one per physical core), matching the torch setup above
+    options = onnxruntime.SessionOptions()
+    options.inter_op_num_threads = 1
+    return options
+
+
+def int8_quantization_config():
+    # Dynamic int8 quantization; use the VNNI kernels on CPUs that have them, AVX2 otherwise
+    try:
+        cpu_info = Path("/proc/cpuinfo").read_text()
+    except OSError:
+        cpu_info = ""
+    if "avx512_vnni" in cpu_info:
+        return AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    return AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+
+
+def save_atomically(target_dir, save):
+    # Save to a scratch directory and rename it into place, so an interrupted save is never reused
+    ONNX_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=ONNX_CACHE_DIR))
+    try:
+        save(tmp_dir)
+        try:
+            tmp_dir.rename(target_dir)
+        except OSError:
+            # Another process finished the same save first; its copy is just as good
+            if not target_dir.exists():
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_onnx_model(model_class, model_name, quantize=False):
+    # Export once and reuse the saved ONNX graph on later server starts
+    export_dir = ONNX_CACHE_DIR / model_name.replace("/", "--")
+    if not export_dir.exists():
+        model = model_class.from_pretrained(model_name, export=True, session_options=onnx_session_options())
+        save_atomically(export_dir, model.save_pretrained)
+        if not quantize:
+            return model
+    if not quantize:
+        return model_class.from_pretrained(export_dir, session_options=onnx_session_options())
+    # Int8 weights cut the bytes moved per decode step; the quantized graph is cached next to the export
+    quantized_dir = export_dir.with_name(export_dir.name + "--int8")
+    if not quantized_dir.exists():
+        quantizer = ORTQuantizer.from_pretrained(export_dir, file_name="model.onnx")
+        save_atomically(
+            quantized_dir,
+            lambda save_dir: quantizer.quantize(quantization_config=int8_quantization_config(), save_dir=save_dir)
+        )
+    return model_class.from_pretrained(
+        quantized_dir, file_name="model_quantized.onnx", session_options=onnx_session_options()
+    )
+
+
+# Load models once per server process; Streamlit reruns the script on every interaction.
+# The cached objects are shared by every session, so only one copy of each model is held in memory.
+# low_cpu_mem_usage skips the random-init-then-overwrite pass when loading weights.
+@st.cache_resource(show_spinner=False)
+def get_emotion_model():
+    processor = AutoImageProcessor.from_pretrained(EMOTION_MODEL)
+    if USE_ONNX:
+        model = load_onnx_model(ORTModelForImageClassification, EMOTION_MODEL)
+    else:
+        model = AutoModelForImageClassification.from_pretrained(
+            EMOTION_MODEL, low_cpu_mem_usage=True, torch_dtype=TORCH_DTYPE
+        ).to(DEVICE)
+        model.eval()
+    return processor, model, model.config.id2label
+
+
+# Returns the raw tokenizer and model; generate() is called directly to skip pipeline overhead
+@st.cache_resource(show_spinner=False)
+def get_story_model(model_name=STORY_MODELS[0]):
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if USE_ONNX:
+        model = load_onnx_model(ORTModelForCausalLM, model_name, quantize=True)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name, low_cpu_mem_usage=True, torch_dtype=TORCH_DTYPE
+        ).to(DEVICE)
+        model.eval()
+        # Compile the decode step into fused kernels; generate() keeps working on the wrapped forward.
+        # dynamic=True keeps sequence lengths symbolic, so the growing KV cache doesn't force recompiles,
+        # and skipping CUDA graphs keeps the shared model safe to call from concurrent sessions.
+        model.forward = torch.compile(model.forward, dynamic=True, fullgraph=False)
+    # GPT-2 has no pad token; left-pad with EOS so batched prompts end where generation starts
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    if not USE_ONNX:
+        # Pay the compile cost here, inside the cached loader, rather than on the first story.
+        # Dynamo specializes on batch size 1, so warm up the single-story graph and a batched one.
+        generate_stories(tokenizer, model, ["neutral"], max_new_tokens=4)
+        generate_stories(tokenizer, model, ["neutral", "happy"], max_new_tokens=4)
+    return tokenizer, model
+
+
+def classify_emotions(processor, model, id2label, images):
+    # Call the processor and model directly; the pipeline wrapper's per-call overhead dominates for this small model
+    labels = []
+    with torch.inference_mode():
+        for i in range(0, len(images), EMOTION_BATCH_SIZE):
+            inputs = processor(images[i:i + EMOTION_BATCH_SIZE], return_tensors="pt").to(DEVICE, dtype=TORCH_DTYPE)
+            indices = model(**inputs).logits.argmax(-1).tolist()
+            labels.extend(id2label[idx].lower() for idx in indices)
+    return labels
+
+
+# There are only a handful of emotion labels, so each batch of prompts is tokenized once per story model.
+# The leading underscore keeps the tokenizer out of the cache key, which is (model_name, emotions).
+@st.cache_resource(show_spinner=False, max_entries=64)
+def encode_prompts(_tokenizer, model_name, emotions):
+    prompts = [STORY_PROMPT.format(emotion=emotion) for emotion in emotions]
+    return dict(_tokenizer(prompts, return_tensors="pt", padding=True))
+
+
+def generate_stories(tokenizer, model, emotions, max_new_tokens, streamer=None, stopping_criteria=None):
+    encoded = encode_prompts(tokenizer, tokenizer.name_or_path, tuple(emotions))
+    inputs = {name: tensor.to(model.device) for name, tensor in encoded.items()}
+    with torch.inference_mode():
+        output_ids = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.8,
+            num_beams=1,
+            use_cache=True,
+            pad_token_id=tokenizer.eos_token_id,
+            streamer=streamer,
+            stopping_criteria=stopping_criteria
+        )
+    return tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+
+class StopOnEvent(StoppingCriteria):
+    # Lets the page stop a background generation it has given up waiting for
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def stream_story(tokenizer, model, emotion, max_new_tokens):
+    # Render tokens as they are produced so the story starts appearing after the first token
+    streamer = TextIteratorStreamer(
+        tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TIMEOUT
+    )
+    errors = []
+    stop = Event()
+
+    def run_generation():
+        try:
+            generate_stories(
+                tokenizer,
+                model,
+                [emotion],
+                max_new_tokens,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([StopOnEvent(stop)])
+            )
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # Always release the reader below, even when generation fails before the first token
+            streamer.end()
+
+    thread = Thread(target=run_generation)
+    thread.start()
+    placeholder = st.empty()
+    story_text = STORY_PROMPT.format(emotion=emotion)
+    try:
+        for text in streamer:
+            story_text += text
+            placeholder.markdown(story_text)
+    except queue.Empty:
+        # Stop the generation after its current step so the thread does not keep running unobserved
+        stop.set()
+        thread.join()
+        raise RuntimeError(
+            f"Story generation timed out (no new text for {STREAM_TIMEOUT} seconds)"
+        ) from None
+    thread.join()
+    if errors:
+        raise errors[0]
+    return story_text
+
+
+def load_image(uploaded_file):
+    image = Image.open(uploaded_file)
+    original_size = image.size
+    # Let libjpeg-turbo decode large JPEGs at a reduced DCT scale instead of full resolution
+    image.draft("RGB", MAX_DECODE_SIZE)
+    # JPEGs already decode to RGB; only convert other modes (e.g. PNG with alpha) to avoid a full copy
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image, original_size
+
+
 # Title and description
 st.title("😊 Emotion Detection using Facial Emotion Recognition")
 st.markdown("---")
@@ -25,8 +287,33 @@ with st.sidebar:
     Upload an image of a face to detect the emotion and generate a story!
     """)
     st.markdown("---")
+    story_model_name = st.selectbox(
+        "Story model",
+        STORY_MODELS,
+        help="Smaller models generate much faster; larger ones write better stories"
+    )
+    generate_story = st.checkbox(
+        "Generate a story",
+        value=True,
+        help="Untick to only detect the emotion; the story model is then never loaded"
+    )
+    story_length = st.slider(
+        "Story Length",
+        min_value=50,
+        max_value=300,
+        value=120,
+        help="Maximum number of new tokens to generate; shorter stories finish faster"
+    )
+    st.markdown("---")
     st.markdown("**Note:** The models will be downloaded on first run (this may take a few minutes)")
 
+# Warm the model cache before the uploader is shown; later reruns are cache hits
+if WARMUP:
+    with st.spinner("Loading models..."):
+        get_emotion_model()
+        if generate_story:
+            get_story_model(story_model_name)
+
 # Main content area
 col1, col2 = st.columns([1, 1])
 
@@ -34,74 +321,120 @@ with col1:
     st.header("📤 Upload Image")
     
     # Image uploader
-    uploaded_file = st.file_uploader(
-        "Choose an image file",
+    uploaded_files = st.file_uploader(
+        "Choose image files",
         type=['jpg', 'jpeg', 'png', 'bmp'],
-        help="Upload an image containing a face for emotion detection"
+        accept_multiple_files=True,
+        help="Upload one or more images containing a face for emotion detection"
     )
     
-    # Display uploaded image
-    if uploaded_file is not None:
-        image = Image.open(uploaded_file).convert("RGB")
-        st.image(image, caption="Uploaded Image", use_column_width=True)
+    # Display uploaded images
+    if uploaded_files:
+        images, original_sizes = zip(*(load_image(f) for f in uploaded_files))
+        file_names = [f.name for f in uploaded_files]
+        single_image = len(images) == 1
         
-        # Display image info
-        st.info(f"**Image details:** {image.size[0]}×{image.size[1]} pixels | Mode: {image.mode}")
+        if single_image:
+            st.image(images[0], caption="Uploaded Image", use_column_width=True)
+            
+            # Display image info
+            width, height = original_sizes[0]
+            st.info(f"**Image details:** {width}×{height} pixels | Mode: {images[0].mode}")
+        else:
+            st.image(list(images), caption=file_names, use_column_width=True)
+            st.info(f"**{len(images)} images uploaded**")
         
         # Process button
-        if st.button("🔍 Detect Emotion & Generate Story", type="primary", use_container_width=True):
-            with st.spinner("Analyzing image and generating story..."):
+        button_label = "🔍 Detect Emotion & Generate Story" if generate_story else "🔍 Detect Emotion"
+        if st.button(button_label, type="primary", use_container_width=True):
+            with st.spinner("Analyzing image and generating story..." if generate_story else "Analyzing image..."):
                 try:
-                    # Initialize emotion detection pipeline
-                    with st.status("Loading emotion detection model...", expanded=True) as status:
-                        emotion_pipe = pipeline("image-classification", model="LaiMein/Facial-Emotion-Recognition")
-                        status.update(label="✅ Emotion detection model loaded!", state="complete")
+                    # Initialize emotion detection model
+                    emotion_processor, emotion_model, emotion_labels = get_emotion_model()
+                    
+                    # Load the story model in the background while the images are classified
+                    executor = ThreadPoolExecutor(max_workers=1)
+                    story_future = executor.submit(get_story_model, story_model_name) if generate_story else None
                     
-                    # Detect emotion
-                    with st.status("Detecting emotion from image...", expanded=True) as status:
-                        emotion_pred = emotion_pipe(image)[0]['label'].lower()
-                        status.update(label=f"✅ Emotion detected: **{emotion_pred.upper()}**", state="complete")
+                    # Detect emotion for all images in one batched call
+                    try:
+                        with st.status("Detecting emotion from image...", expanded=True) as status:
+                            small_images = []
+                            for image in images:
+                                small_image = image.copy()
+                                small_image.thumbnail(CLASSIFIER_INPUT_SIZE, Image.Resampling.BILINEAR)
+                                small_images.append(small_image)
+                            emotion_preds = classify_emotions(
+                                emotion_processor, emotion_model, emotion_labels, small_images
+                            )
+                            detected = ", ".join(pred.upper() for pred in emotion_preds)
+                            status.update(label=f"✅ Emotion detected: **{detected}**", state="complete")
+                    except Exception:
+                        # Report the error now instead of waiting for a story model load nobody will use
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        raise
+                    # story_future.result() below is the only place that waits for the load
+                    executor.shutdown(wait=False)
                     
                     # Display emotion result
-                    st.success(f"**Detected Emotion:** {emotion_pred.upper()}")
+                    if single_image:
+                        st.success(f"**Detected Emotion:** {emotion_preds[0].upper()}")
+                    else:
+                        st.success("\n".join(
+                            f"- **{name}:** {pred.upper()}" for name, pred in zip(file_names, emotion_preds)
+                        ))
                     
                     # Generate story
-                    with st.status("Generating story based on emotion...", expanded=True) as status:
-                        story_pipe = pipeline("text-generation", model="openai-community/gpt2")
-                        status.update(label="✅ Story generator model loaded!", state="complete")
-                    
-                    with st.status("Creating creative story...", expanded=True) as status:
-                        story = story_pipe(
-                            f"Tell a short creative story about this {emotion_pred} person",
-                            max_length=500,
-                            max_new_tokens=500,
-                            do_sample=True,
-                            temperature=0.8
-                        )
-                        status.update(label="✅ Story generated successfully!", state="complete")
-                    
-                    # Display story in col2
-                    with col2:
-                        st.header("📖 Generated Story")
-                        st.markdown("---")
-                        st.markdown(f"**Based on the emotion:** _{emotion_pred}_")
-                        st.markdown("---")
+                    if story_future is not None:
+                        story_tokenizer, story_model = story_future.result()
                         
-                        # Create a nice container for the story
-                        story_container = st.container()
-                        with story_container:
-                            st.markdown("### 📝 The Story:")
-                            st.write(story[0]['generated_text'])
-                        
-                        # Add download button for the story
-                        story_text = story[0]['generated_text']
-                        st.download_button(
-                            label="📥 Download Story as Text",
-                            data=story_text,
-                            file_name=f"story_{emotion_pred}.txt",
-                            mime="text/plain",
-                            use_container_width=True
-                        )
+                        # A single story is streamed into the page below; several are generated in batches
+                        if single_image:
+                            story_texts = [None]
+                        else:
+                            story_texts = []
+                            with st.status("Creating creative stories...", expanded=True) as status:
+                                for i in range(0, len(emotion_preds), STORY_BATCH_SIZE):
+                                    story_texts.extend(generate_stories(
+                                        story_tokenizer,
+                                        story_model,
+                                        emotion_preds[i:i + STORY_BATCH_SIZE],
+                                        story_length
+                                    ))
+                                status.update(label="✅ Stories generated successfully!", state="complete")
+                    
+                        # Display stories in col2
+                        with col2:
+                            st.header("📖 Generated Story" if single_image else "📖 Generated Stories")
+                            for i, (name, emotion_pred, story_text) in enumerate(
+                                zip(file_names, emotion_preds, story_texts)
+                            ):
+                                st.markdown("---")
+                                if not single_image:
+                                    st.subheader(name)
+                                st.markdown(f"**Based on the emotion:** _{emotion_pred}_")
+                                st.markdown("---")
+                                
+                                # Create a nice container for the story
+                                story_container = st.container()
+                                with story_container:
+                                    st.markdown("### 📝 The Story:")
+                                    if story_text is None:
+                                        story_text = stream_story(
+                                            story_tokenizer, story_model, emotion_pred, story_length
+                                        )
+                                    else:
+                                        st.write(story_text)
+                                
+                                # Add download button for the story
+                                st.download_button(
+                                    label="📥 Download Story as Text",
+                                    data=story_text,
+                                    file_name=f"story_{emotion_pred}.txt",
+                                    mime="text/plain",
+                                    use_container_width=True,
+                                    key=f"download_story_{i}"
+                                )
                 
                 except Exception as e:
                     st.error(f"An error occurred: {str(e)}")
@@ -115,7 +448,7 @@ with col1:
         with col2:
             st.header("📖 How it Works")
             st.markdown("""
-            1. **Upload** an image containing a face
+            1. **Upload** one or more images containing a face
             2. **Click** the 'Detect Emotion & Generate Story' button
             3. **View** the detected emotion and generated story
             
@@ -135,9 +468,4 @@ with col1:
 
 # Footer
 st.markdown("---")
-st.markdown(
-    "<div style='text-align: center; color: #666;'>"
-    "Powered by 🤗 Transformers | Built with Streamlit"
-    "</div>",
-    unsafe_allow_html=True
-)
+st.markdown(FOOTER_HTML, unsafe_allow_html=True)